@@ -1,6 +1,13 @@
+import hashlib
+import os
+import tempfile
+
 import numpy as np
 from vispy import app, scene
-from vispy.scene.visuals import Mesh, Markers
+from vispy.color import Colormap
+from vispy.scene.visuals import Mesh, Markers, create_visual_node
+from vispy.util.transforms import rotate, translate
+from vispy.visuals import VolumeVisual
 from vispy.visuals.transforms import MatrixTransform
 from skimage import measure
 import matplotlib.pyplot as plt
@@ -9,17 +16,71 @@ ROTATION_SPEED = 2
 SHOW_ELECTRODES = True
 NUM_LAYERS = 5  # Multiple semi-transparent layers for hologram effect
 COLORMAP = plt.cm.viridis  # Less yellow, more blue-green-purple
+COLOR_LUT = COLORMAP(np.linspace(0, 1, 256)).astype(np.float32)  # (256, 4) RGBA lookup table
+MESH_CACHE_DIR = ".mesh_cache"
+RENDER_MODE = "volume"  # "volume" (GPU ray-cast isosurfaces) or "mesh" (cached marching cubes)
+
+# Shade every crossing of an evenly spaced iso level along the ray and add it up,
+# which mimics NUM_LAYERS translucent isosurface meshes drawn with additive blending
+_LAYERED_ISO_SNIPPETS = dict(
+    before_loop="""
+        vec3 dstep = 1.5 / u_shape;  // step to sample derivative
+        vec3 integrated_color = vec3(0.0);
+        float prev_layer = -2.0;
+        bool discard_fragment = true;
+        """,
+    in_loop="""
+        float layer = clamp(floor((val - %(low)f) / %(spacing)f), -1.0, %(top)f);
+        if (prev_layer > -2.0 && layer != prev_layer) {
+            float surface = max(layer, prev_layer);
+            float shade = calculateColor(vec4(1.0), loc, dstep).r;
+            float alpha = 0.15 + 0.1 * (surface + 1.0) / %(n)f;
+            integrated_color += $cmap(loc.z).rgb * shade * alpha;  // clim is (0, 1), gamma 1
+            if (discard_fragment) {
+                frag_depth_point = loc * u_shape;
+                discard_fragment = false;
+            }
+        }
+        prev_layer = layer;
+        """,
+    after_loop="""
+        if (discard_fragment)
+            discard;
+        gl_FragColor = vec4(integrated_color, 1.0);
+        """,
+)
+
+
+class LayeredIsoVolumeVisual(VolumeVisual):
+    """Volume visual rendering several isosurfaces in a single ray-casting pass"""
+
+    def __init__(self, vol, iso_levels, **kwargs):
+        n = len(iso_levels)
+        low, high = float(iso_levels[0]), float(iso_levels[-1])
+        values = dict(low=low, spacing=(high - low) / max(n - 1, 1), top=n - 1.0, n=float(n))
+        snippets = {k: v % values if k == "in_loop" else v for k, v in _LAYERED_ISO_SNIPPETS.items()}
+        self._rendering_methods = dict(VolumeVisual._rendering_methods, layered_iso=snippets)
+        super().__init__(vol, method="layered_iso", **kwargs)
+
+
+LayeredIsoVolume = create_visual_node(LayeredIsoVolumeVisual)
+
+
+def lut_colors(values):
+    """Map values in [0, 1] to RGBA with a table lookup instead of a colormap call"""
+    return COLOR_LUT[np.clip(values * 255, 0, 255).astype(np.uint8)]
 
 voxels = np.load("voxels.npy").astype("float32")
 ch_pos = np.load("ch_pos.npy").astype("float32")
 
-# Clean and normalize
-voxels = np.nan_to_num(voxels, nan=0.0, posinf=0.0, neginf=0.0)
-voxels = np.abs(voxels) ** 2
+# Clean and normalize (in place, no full-size temporaries)
+np.nan_to_num(voxels, copy=False, nan=0.0, posinf=0.0, neginf=0.0)
+np.square(voxels, out=voxels)
 vmin, vmax = np.percentile(voxels, [5, 99.5])
-voxels = np.clip(voxels, vmin, vmax)
-voxels = (voxels - vmin) / (vmax - vmin + 1e-8)
-voxels = voxels ** 0.5
+np.clip(voxels, vmin, vmax, out=voxels)
+voxels -= vmin
+voxels /= vmax - vmin + 1e-8
+np.sqrt(voxels, out=voxels)
 
 print(f"Voxel shape: {voxels.shape}")
 
@@ -30,66 +91,130 @@ view = canvas.central_widget.add_view()
 mesh_layers = []
 iso_levels = np.linspace(0.3, 0.8, NUM_LAYERS)
 
-try:
-    for idx, level in enumerate(iso_levels):
-        verts, faces, normals, values = measure.marching_cubes(voxels[0], level=level)
-        
-        # Color with gradient + transparency
-        intensity = (idx + 1) / NUM_LAYERS
-        colors = COLORMAP(verts[:, 2] / voxels.shape[3])
-        colors[:, 3] = 0.15 + 0.1 * intensity  # Semi-transparent
-        
-        mesh = Mesh(vertices=verts, faces=faces, vertex_colors=colors, shading='smooth')
+
+def build_mesh_cache(voxels, iso_levels):
+    """Run marching cubes once per (frame, level), reusing results saved on disk"""
+    key = hashlib.blake2b(digest_size=8)
+    key.update(repr((voxels.shape, tuple(float(l) for l in iso_levels))).encode())
+    key.update(memoryview(np.ascontiguousarray(voxels)).cast("B"))
+    path = os.path.join(MESH_CACHE_DIR, f"{key.hexdigest()}.npz")
+
+    mesh_cache = [[None] * len(iso_levels) for _ in range(len(voxels))]
+    if os.path.exists(path):
+        with np.load(path) as stored:
+            for i in range(len(voxels)):
+                for idx in range(len(iso_levels)):
+                    if f"verts_{i}_{idx}" in stored:
+                        mesh_cache[i][idx] = (stored[f"verts_{i}_{idx}"],
+                                              stored[f"faces_{i}_{idx}"],
+                                              stored[f"colors_{i}_{idx}"])
+        print(f"Loaded cached meshes from {path}")
+        return mesh_cache
+
+    arrays = {}
+    for i in range(len(voxels)):
+        for idx, level in enumerate(iso_levels):
+            try:
+                verts, faces, normals, values = measure.marching_cubes(voxels[i], level=level)
+            except (ValueError, RuntimeError):
+                continue  # No surface at this level
+
+            # Color with gradient + transparency
+            intensity = (idx + 1) / NUM_LAYERS
+            colors = lut_colors(verts[:, 2] / voxels.shape[3])
+            colors[:, 3] = 0.15 + 0.1 * intensity  # Semi-transparent
+
+            verts = verts.astype(np.float32)
+            faces = faces.astype(np.uint32)
+            mesh_cache[i][idx] = (verts, faces, colors)
+            arrays[f"verts_{i}_{idx}"] = verts
+            arrays[f"faces_{i}_{idx}"] = faces
+            arrays[f"colors_{i}_{idx}"] = colors
+
+    # Write to a temporary file and rename, so an interrupted save never leaves a truncated archive
+    os.makedirs(MESH_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix=".npz.tmp", dir=MESH_CACHE_DIR)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return mesh_cache
+
+
+center = np.array(voxels[0].shape) / 2
+
+if RENDER_MODE == "volume":
+    # Volume textures are indexed (z, y, x), transpose so axes match the mesh/particle coordinates
+    holo = LayeredIsoVolume(
+        np.ascontiguousarray(voxels[0].T),
+        iso_levels,
+        clim=(0.0, 1.0),
+        cmap=Colormap(COLOR_LUT),
+        parent=view.scene,
+    )
+    holo.set_gl_state('additive', depth_test=False, cull_face=False)
+    holo.transform = MatrixTransform()
+    holo.transform.translate(-center)
+    mesh_cache = None
+    print(f"Ray casting {len(iso_levels)} hologram layers on the GPU")
+else:
+    holo = None
+    mesh_cache = build_mesh_cache(voxels, iso_levels)
+
+    for idx in range(len(iso_levels)):
+        if mesh_cache[0][idx] is not None:
+            verts, faces, colors = mesh_cache[0][idx]
+            mesh = Mesh(vertices=verts, faces=faces, vertex_colors=colors, shading='smooth')
+        else:
+            mesh = Mesh(shading='smooth')
         mesh.set_gl_state('translucent', depth_test=True, cull_face=False, blend=True, 
                           blend_func=('src_alpha', 'one'))  # Additive blending
         mesh.transform = MatrixTransform()
-        
-        center = np.array(voxels[0].shape) / 2
         mesh.transform.translate(-center)
         view.add(mesh)
         mesh_layers.append(mesh)
-    
+
     print(f"Created {len(mesh_layers)} hologram layers")
-except Exception as e:
-    print(f"Error creating layers: {e}")
 
 # Add glowing particles at high-intensity voxels
+rng = np.random.default_rng()
+
 def create_particles(volume, threshold=0.8, max_points=3000):
     """Extract high-intensity voxels as glowing particles"""
-    high_intensity = np.where(volume > threshold)
+    flat_idx = np.flatnonzero(volume > threshold)
     
-    if len(high_intensity[0]) == 0:
-        return None, None
+    if len(flat_idx) == 0:
+        return None, None, None
     
-    # Subsample if too many points
-    indices = np.random.choice(len(high_intensity[0]), 
-                              min(len(high_intensity[0]), max_points), 
-                              replace=False)
+    # Subsample if too many points (draw order doesn't matter, so skip the shuffle)
+    if len(flat_idx) > max_points:
+        flat_idx = flat_idx[rng.choice(len(flat_idx), max_points, replace=False, shuffle=False)]
     
-    positions = np.column_stack([high_intensity[0][indices], 
-                                 high_intensity[1][indices], 
-                                 high_intensity[2][indices]]).astype(np.float32)
-    
-    intensities = volume[high_intensity[0][indices], 
-                         high_intensity[1][indices], 
-                         high_intensity[2][indices]]
+    positions = np.stack(np.unravel_index(flat_idx, volume.shape), axis=1).astype(np.float32)
+    intensities = volume.ravel()[flat_idx]
     
     # Color and size based on intensity
-    colors = COLORMAP(intensities)
+    colors = lut_colors(intensities)
     colors[:, 3] = intensities * 0.5  # More transparent
     sizes = 2 + intensities * 6  # Smaller particles
     
     return positions, colors, sizes
 
+# Voxels are static, so extract each frame's particles once
+particles_cache = [create_particles(frame) for frame in voxels]
+print(f"Cached particles for {len(particles_cache)} frames")
+
 # Create initial particles
-pos, cols, szs = create_particles(voxels[0])
+pos, cols, szs = particles_cache[0]
 if pos is not None:
     particles = Markers()
     particles.set_data(pos, face_color=cols, size=szs, edge_width=0)
     particles.set_gl_state('translucent', depth_test=False, blend=True,
                           blend_func=('src_alpha', 'one'))
     particles.transform = MatrixTransform()
-    center = np.array(voxels[0].shape) / 2
     particles.transform.translate(-center)
     view.add(particles)
 else:
@@ -97,9 +222,8 @@ else:
 
 # Add electrode markers (subtle)
 if SHOW_ELECTRODES:
-    center_pos = np.array([voxels.shape[1], voxels.shape[2], voxels.shape[3]]) / 2
     elec_markers = Markers()
-    elec_markers.set_data(ch_pos - center_pos, face_color=(0.3, 0.8, 1.0, 0.4),  # Cyan, semi-transparent
+    elec_markers.set_data(ch_pos - center, face_color=(0.3, 0.8, 1.0, 0.4),  # Cyan, semi-transparent
                          size=4, edge_width=0)
     elec_markers.transform = MatrixTransform()
     view.add(elec_markers)
@@ -111,50 +235,38 @@ view.camera.distance = 80
 current_frame = [0]
 rotation = [0]
 
+# Everything but the (already centered) electrodes is shifted to the origin before rotating
+centered = [visual for visual in [holo, *mesh_layers, particles] if visual is not None]
+center_matrix = translate(-center)
+
 def update(ev):
-    try:
-        i = (current_frame[0] + 1) % len(voxels)
-        current_frame[0] = i
-        
-        # Update each isosurface layer
-        for idx, (mesh, level) in enumerate(zip(mesh_layers, iso_levels)):
-            try:
-                verts, faces, normals, values = measure.marching_cubes(voxels[i], level=level)
-                
-                intensity = (idx + 1) / NUM_LAYERS
-                colors = COLORMAP(verts[:, 2] / voxels.shape[3])
-                colors[:, 3] = 0.15 + 0.1 * intensity
-                
-                mesh.set_data(vertices=verts, faces=faces, vertex_colors=colors)
-            except:
-                pass  # Skip if no surface at this level
-        
-        # Update particles
-        if particles is not None:
-            pos, cols, szs = create_particles(voxels[i])
-            if pos is not None:
-                particles.set_data(pos - center, face_color=cols, size=szs)
-        
-        # Rotate everything
-        rotation[0] += ev.dt * ROTATION_SPEED
-        center = np.array(voxels[0].shape) / 2
-        
-        for mesh in mesh_layers:
-            mesh.transform.reset()
-            mesh.transform.translate(-center)
-            mesh.transform.rotate(rotation[0], (0, 0, 1))
-        
-        if particles is not None:
-            particles.transform.reset()
-            particles.transform.translate(-center)
-            particles.transform.rotate(rotation[0], (0, 0, 1))
-        
-        if SHOW_ELECTRODES:
-            elec_markers.transform.reset()
-            elec_markers.transform.rotate(rotation[0], (0, 0, 1))
-        
-    except Exception as e:
-        pass  # Silent fail for smoother animation
+    i = (current_frame[0] + 1) % len(voxels)
+    current_frame[0] = i
+    
+    # Update the ray-cast volume, or each isosurface layer from the precomputed meshes
+    if holo is not None:
+        holo.set_data(np.ascontiguousarray(voxels[i].T))
+    for idx, mesh in enumerate(mesh_layers):
+        if mesh_cache[i][idx] is not None:
+            verts, faces, colors = mesh_cache[i][idx]
+            mesh.set_data(vertices=verts, faces=faces, vertex_colors=colors)
+    
+    # Update particles
+    if particles is not None:
+        pos, cols, szs = particles_cache[i]
+        if pos is not None:
+            particles.set_data(pos, face_color=cols, size=szs, edge_width=0)
+    
+    # Rotate everything
+    rotation[0] += ev.dt * ROTATION_SPEED
+    rotation_matrix = rotate(rotation[0], (0, 0, 1))
+    matrix = center_matrix @ rotation_matrix
+    
+    for visual in centered:
+        visual.transform.matrix = matrix
+    
+    if SHOW_ELECTRODES:
+        elec_markers.transform.matrix = rotation_matrix
 
 timer = app.Timer(1 / 30, connect=update, start=True)
 
@@ -1,14 +1,31 @@
+import hashlib
+import os
+import tempfile
+
 import numpy as np
 from vispy import app, scene
-from vispy.scene import Node
-from vispy.scene.visuals import Sphere, Volume
-from vispy.visuals.transforms import MatrixTransform, STTransform
+from vispy.geometry import create_sphere
+from vispy.gloo import gl
+from vispy.scene.visuals import Mesh, create_visual_node
+from vispy.visuals import VolumeVisual
+from vispy.util.transforms import rotate, scale as scale_matrix, translate
+from vispy.visuals.transforms import MatrixTransform
 from vispy.color import Colormap
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import gaussian_filter, zoom
 from PyQt6.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QLabel, 
                              QSlider, QPushButton, QGroupBox)
 from PyQt6.QtCore import Qt
 
+try:
+    import gputools  # optional: OpenCL separable convolution
+except ImportError:
+    gputools = None
+
+try:
+    from numba import njit, prange  # optional: fused voxel processing
+except ImportError:
+    njit, prange = None, range
+
 # Load data
 voxels_raw = np.load("voxels.npy").astype("float32")
 ch_pos = np.load("ch_pos.npy").astype("float32")
@@ -16,6 +33,16 @@ voxels_raw = np.nan_to_num(voxels_raw, nan=0.0, posinf=0.0, neginf=0.0)
 voxels_raw = np.abs(voxels_raw)
 
 print(f"Loaded {len(voxels_raw)} frames")
+raw_digest = hashlib.blake2b(memoryview(voxels_raw).cast("B"), digest_size=8).hexdigest()
+
+GL_MAX_3D_TEXTURE_SIZE = 0x8073  # not among vispy.gloo.gl's (GL ES 2.0) constants
+FRAME_STACK_MAX_BYTES = 512 * 2**20  # VRAM the stacked series may take; integrated GPUs share 1-2 GB
+FRAME_INTERVAL = 1 / 30  # playback advances frame_skip frames this often, whatever the redraw rate
+VOXEL_CACHE_DIR = ".voxels_cache"
+CACHE_VERSION = 1  # bump whenever process_voxels changes its output
+# Parameters that change the output of process_voxels (the rest only affect rendering)
+PROCESS_KEYS = ('smoothing', 'contrast', 'brightness', 'percentile_min', 'percentile_max',
+                'log_scale', 'target_side')
 
 # Create smooth colormap - deep blue -> purple -> magenta -> pink
 colors = np.array([
@@ -50,43 +77,254 @@ params = {
     'percentile_max': 95.0,  # Less aggressive
     'frame_skip': 1,
     'log_scale': 0.0,  # Turn off - not needed with original norm
+    'target_side': 256,  # Largest volume side uploaded to the GPU
 }
 
+def gaussian_weights(sigma, truncate=4.0):
+    """1D Gaussian kernel with the same support as scipy.ndimage.gaussian_filter"""
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1, dtype=np.float32)
+    weights = np.exp(-0.5 * (x / sigma) ** 2)
+    return weights / weights.sum()
+
+def smooth_voxels(voxels, sigma):
+    """Gaussian-smooth every frame in place, on the GPU when gputools is available"""
+    if gputools is not None:
+        h = gaussian_weights(sigma)
+        for i in range(len(voxels)):
+            voxels[i] = gputools.convolve_sep3(voxels[i], h, h, h)
+    else:
+        for i in range(len(voxels)):
+            voxels[i] = gaussian_filter(voxels[i], sigma=sigma)
+    return voxels
+
+def log_mix(values, log_scale):
+    """Blend values with log(values + 1) to compress high values"""
+    values = values + 1e-8
+    return (1 - log_scale) * values + log_scale * np.log(values + 1)
+
+def _pipeline_kernel(src, dst, offset, scale, log_scale, contrast, brightness):
+    """Log mix, normalize, contrast, brightness and clip in a single pass over memory"""
+    n_frames, depth, height, width = src.shape
+    for t in prange(n_frames):
+        for z in range(depth):
+            for y in range(height):
+                for x in range(width):
+                    v = src[t, z, y, x]
+                    if log_scale > 0:
+                        v += 1e-8
+                        v = (1 - log_scale) * v + log_scale * np.log(v + 1)
+                    v = min(1.0, max(0.0, (v - offset[t]) / scale[t]))
+                    dst[t, z, y, x] = min(1.0, v ** contrast * brightness)
+
+fused_pipeline = njit(parallel=True, fastmath=True, cache=True)(_pipeline_kernel) if njit else None
+
+# Backends round differently, so cached voxels are only reused under the ones that wrote them
+PROCESS_BACKENDS = ("numba" if fused_pipeline else "numpy", "gputools" if gputools else "scipy")
+
+def downsample_voxels(voxels, target_side):
+    """Trilinearly resample frames so that no spatial side exceeds target_side"""
+    factor = min(1.0, target_side / max(voxels.shape[1:]))
+    if factor < 1:
+        voxels = zoom(voxels, (1, factor, factor, factor), order=1)
+    return voxels
+
+# Scratch buffer reused by every reprocess instead of copying voxels_raw each time
+scratch = np.empty_like(voxels_raw)
+
 # Process voxels with current parameters
 def process_voxels():
-    voxels = voxels_raw.copy()
-    
-    # Logarithmic scaling to compress high values
+    # Per-frame normalization bounds. The log mix is monotonic, so the percentiles
+    # of the mixed data are (up to interpolation) the mixed raw percentiles
+    flat = voxels_raw.reshape(len(voxels_raw), -1)
+    vmin, vmax = np.percentile(flat, [params['percentile_min'], params['percentile_max']], axis=1)
     if params['log_scale'] > 0:
-        voxels = voxels + 1e-8
-        log_voxels = np.log(voxels + 1)
-        voxels = (1 - params['log_scale']) * voxels + params['log_scale'] * log_voxels
+        vmin, vmax = log_mix(vmin, params['log_scale']), log_mix(vmax, params['log_scale'])
+    valid = vmax > vmin  # leave flat frames unscaled
+    offset = np.where(valid, vmin, 0.0).astype(np.float32)
+    scale = np.where(valid, vmax - vmin, 1.0).astype(np.float32)
     
-    # Normalize per-frame with AGGRESSIVE clipping
-    for i in range(len(voxels)):
-        frame = voxels[i]
-        vmin, vmax = np.percentile(frame, [params['percentile_min'], params['percentile_max']])
-        if vmax > vmin:
-            voxels[i] = np.clip((frame - vmin) / (vmax - vmin), 0, 1)
-    
-    # Power law to push values DOWN
-    voxels = voxels ** params['contrast']
-    
-    # Final brightness adjustment
-    voxels = voxels * params['brightness']
-    voxels = np.clip(voxels, 0, 1)
+    voxels = scratch
+    if fused_pipeline is not None:
+        fused_pipeline(voxels_raw, voxels, offset, scale,
+                       params['log_scale'], params['contrast'], params['brightness'])
+    else:
+        np.copyto(voxels, voxels_raw)
+        
+        # Logarithmic scaling to compress high values
+        if params['log_scale'] > 0:
+            voxels += 1e-8
+            log_voxels = np.log1p(voxels)
+            log_voxels *= params['log_scale']
+            voxels *= 1 - params['log_scale']
+            voxels += log_voxels
+            del log_voxels
+        
+        # Normalize per-frame with AGGRESSIVE clipping (all frames at once)
+        np.subtract(voxels, offset[:, None, None, None], out=voxels)
+        np.divide(voxels, scale[:, None, None, None], out=voxels)
+        np.clip(voxels, 0, 1, out=voxels)
+        
+        # Power law to push values DOWN
+        np.power(voxels, params['contrast'], out=voxels)
+        
+        # Final brightness adjustment
+        voxels *= params['brightness']
+        np.clip(voxels, 0, 1, out=voxels)
     
     # Smoothing AFTER processing for smooth gradients
     if params['smoothing'] > 0:
-        for i in range(len(voxels)):
-            voxels[i] = gaussian_filter(voxels[i], sigma=params['smoothing'])
+        smooth_voxels(voxels, params['smoothing'])
+    
+    # Shrink the texture to the VRAM budget; ray casting cost scales with its size
+    voxels = downsample_voxels(voxels, params['target_side'])
+    
+    return voxels
+
+def quantize_voxels(voxels):
+    """Quantize [0, 1] voxels to uint8 so each frame upload is 4x smaller than float32"""
+    return np.clip(voxels * 255 + 0.5, 0, 255).astype(np.uint8)
+
+def load_voxels():
+    """Processed uint8 voxels, memoized on disk for each set of processing parameters"""
+    # Sliders store value / scale, so 256 and 256.0 must hash alike
+    settings = sorted((k, float(params[k])) for k in PROCESS_KEYS)
+    salt = (CACHE_VERSION, PROCESS_BACKENDS)
+    key = hashlib.blake2b(repr((salt, raw_digest, settings)).encode(), digest_size=8).hexdigest()
+    path = os.path.join(VOXEL_CACHE_DIR, f"{key}.npy")
+    if os.path.exists(path):
+        print(f"Loaded cached voxels from {path}")
+        return np.load(path, mmap_mode='r')
+    
+    voxels = quantize_voxels(process_voxels())
     
+    # Write to a temporary file and rename, so an interrupted save never leaves a truncated entry
+    os.makedirs(VOXEL_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix=".npy.tmp", dir=VOXEL_CACHE_DIR)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, voxels)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
     return voxels
 
-voxels = process_voxels()
+def volume_clim():
+    """Color limits in uint8 texture units"""
+    return params['clim_min'] * 255, params['clim_max'] * 255
+
+# Sample one frame out of a (T*D, H, W) texture; z is clamped half a texel inside the
+# frame so linear interpolation never blends in the neighbouring frames
+_FRAME_STACK_LOOKUP = """
+    vec4 texture_lookup(vec3 texcoord) {
+        // no need to discard out of bounds, already checked during raycasting
+        float z = (clamp(texcoord.z, $z_min, 1.0 - $z_min) + $frame) / $n_frames;
+        return texture3D($texture, vec3(texcoord.xy, z));
+    }"""
+
+class FrameStackVolumeVisual(VolumeVisual):
+    """Volume visual holding a whole (T, D, H, W) series in one texture
+
+    The series is uploaded once; switching frames only changes a uniform.
+    Only 'nearest' and 'linear' interpolation are frame-aware.
+    """
+
+    _func_templates = dict(VolumeVisual._func_templates, texture_lookup=_FRAME_STACK_LOOKUP)
+
+    def __init__(self, frames, **kwargs):
+        self._frame = 0
+        self._n_frames, self._depth = frames.shape[:2]
+        kwargs.setdefault('plane_position', [x / 2 for x in frames.shape[1:]])
+        super().__init__(frames, **kwargs)
+
+    @staticmethod
+    def _stack(frames):
+        return frames.reshape(-1, *frames.shape[2:])
+
+    def _create_texture(self, texture_format, data):
+        return super()._create_texture(texture_format, self._stack(data))
+
+    def set_data(self, frames, clim=None, copy=True):
+        """Upload a new (T, D, H, W) series"""
+        super().set_data(self._stack(frames), clim=clim, copy=copy)
+        self._n_frames, self._depth = frames.shape[:2]
+        self._frame %= self._n_frames
+        self._vol_shape = frames.shape[1:]
+        self._need_vertex_update = True
+        self.shared_program['u_shape'] = (frames.shape[3], frames.shape[2], frames.shape[1])
+        self._update_frame_lookup()
+
+    @property
+    def frame(self):
+        """Index of the displayed frame"""
+        return self._frame
+
+    @frame.setter
+    def frame(self, value):
+        self._frame = int(value) % self._n_frames
+        self._update_frame_lookup()
+        self.update()
+
+    def _update_frame_lookup(self):
+        if self._data_lookup_fn is None:
+            return  # set on first draw
+        self._data_lookup_fn['frame'] = float(self._frame)
+        self._data_lookup_fn['n_frames'] = float(self._n_frames)
+        self._data_lookup_fn['z_min'] = 0.5 / self._depth
+
+    def _build_interpolation(self):
+        super()._build_interpolation()
+        self._update_frame_lookup()
+
+FrameStackVolume = create_visual_node(FrameStackVolumeVisual)
+
+class DoubleBufferedVolumeVisual(VolumeVisual):
+    """Volume visual alternating between two textures of the same shape
+
+    The next frame is uploaded into the idle texture with ``prefetch`` while the
+    current one is drawn, so the upload never waits on a texture still in use.
+    ``swap`` then only rebinds the sampler. Requires GPU-scaled data (texture_format set).
+    """
+
+    def __init__(self, vol, **kwargs):
+        self._back_texture = None
+        self._prefetched = None
+        super().__init__(vol, **kwargs)
+
+    def _create_texture(self, texture_format, data):
+        self._back_texture = super()._create_texture(texture_format, data)
+        return super()._create_texture(texture_format, data)
+
+    @property
+    def prefetched(self):
+        """Index of the frame waiting in the back texture, None if there is none"""
+        return self._prefetched
+
+    def prefetch(self, vol, index):
+        """Upload frame ``index`` into the back texture"""
+        self._back_texture.set_clim(self._texture.clim)
+        self._back_texture.check_data_format(vol)
+        self._back_texture.scale_and_set_data(vol, copy=False)
+        self._prefetched = index
+
+    def swap(self):
+        """Display the prefetched frame"""
+        self._back_texture.set_clim(self._texture.clim)
+        self._texture, self._back_texture = self._back_texture, self._texture
+        self._prefetched = None
+        self.shared_program['u_volumetex'] = self._texture
+        self.shared_program['clim'] = self._texture.clim_normalized
+        if self._data_lookup_fn is not None:
+            self._data_lookup_fn['texture'] = self._texture
+        self.update()
+
+DoubleBufferedVolume = create_visual_node(DoubleBufferedVolumeVisual)
+
+voxels = load_voxels()
 
 # Create canvas
-canvas = scene.SceneCanvas(size=(1200, 800), show=True, bgcolor="black", keys='interactive')
+canvas = scene.SceneCanvas(size=(1200, 800), show=True, bgcolor="black", keys='interactive', vsync=True)
 
 # Create main layout widget
 main_widget = QWidget()
@@ -205,8 +443,9 @@ control_layout.addWidget(create_slider('rotation_speed', '7. Rotation Speed', 0,
 control_layout.addWidget(create_slider('brightness', '8. Brightness', 0.1, 2, params['brightness']))
 control_layout.addWidget(create_slider('percentile_min', '9. Norm Min %', 0, 30, params['percentile_min']))
 control_layout.addWidget(create_slider('percentile_max', '10. Norm Max %', 70, 100, params['percentile_max']))
-control_layout.addWidget(create_slider('frame_skip', '11. Animation Speed', 1, 20, params['frame_skip'], scale=1))
+control_layout.addWidget(create_slider('frame_skip', '11. Animation Speed', 0, 20, params['frame_skip'], scale=1))
 control_layout.addWidget(create_slider('log_scale', '12. Log Scale Mix', 0, 1, params['log_scale']))
+control_layout.addWidget(create_slider('target_side', '13. Max Volume Side', 16, 512, params['target_side'], scale=1))
 
 # Reset button
 reset_btn = QPushButton("Reset Defaults")
@@ -257,30 +496,63 @@ control_layout.addStretch()
 # Setup vispy scene
 view = canvas.central_widget.add_view()
 
-first_frame = np.ascontiguousarray(voxels[0], dtype=np.float32)
-holo = Volume(
-    first_frame,
-    parent=view.scene,
-    method="additive",
-    clim=(params['clim_min'], params['clim_max']),
-    cmap=COLORMAP,
-    interpolation='linear',
-    gamma=params['gamma'],
-    relative_step_size=params['step_size'],
-)
-
-holo.set_gl_state('additive', blend=True, depth_test=False, cull_face=False)
-holo.transform = MatrixTransform()
-center = np.array(first_frame.shape) / 2.0
-holo.transform.translate(-center)
-
-# Electrodes
-elecs = Node()
-for ch in ch_pos:
-    sphere = Sphere(radius=0.2, method="ico", subdivisions=2, color="yellow")
-    sphere.mesh.set_gl_state("translucent", depth_test=False)
-    sphere.transform = STTransform(translate=ch)
-    sphere.parent = elecs
+# Scene coordinates follow the full-resolution grid, whatever the uploaded resolution
+center = np.array(voxels_raw.shape[1:]) / 2.0
+center_matrix = translate(-center)
+
+def max_texture_size():
+    """GL_MAX_3D_TEXTURE_SIZE of the canvas context, 0 if it can't be queried"""
+    canvas.set_current()
+    size = gl.glGetParameter(GL_MAX_3D_TEXTURE_SIZE)
+    return size if isinstance(size, int) else 0  # empty tuple when the query failed
+
+def create_volume(voxels):
+    """Create the hologram visual, stacking all frames in one texture when they fit"""
+    volume_kwargs = dict(
+        parent=view.scene,
+        method="additive",
+        clim=volume_clim(),
+        cmap=COLORMAP,
+        interpolation='linear',
+        gamma=params['gamma'],
+        relative_step_size=params['step_size'],
+        texture_format='auto',  # keep uint8 on the GPU, normalized in the shader
+    )
+    stack_depth = len(voxels) * voxels.shape[1]
+    if stack_depth <= max_texture_depth and voxels.nbytes <= FRAME_STACK_MAX_BYTES:
+        # Upload the whole series once and switch frames in the shader
+        volume = FrameStackVolume(voxels, **volume_kwargs)
+    else:
+        print(f"Streaming frames: stacked series would be {stack_depth} texels deep "
+              f"(limit {max_texture_depth}) and {voxels.nbytes / 2**20:.0f} MB "
+              f"(budget {FRAME_STACK_MAX_BYTES / 2**20:.0f} MB)")
+        volume = DoubleBufferedVolume(voxels[current_frame[0]], **volume_kwargs)
+        prefetch_next(volume, voxels, current_frame[0])
+    volume.set_gl_state('additive', blend=True, depth_test=False, cull_face=False)
+    volume.transform = MatrixTransform(volume_scale(voxels) @ center_matrix)
+    return volume
+
+def prefetch_next(volume, voxels, i):
+    """Upload the frame playback reaches after frame i into the back texture"""
+    j = (i + max(1, int(params['frame_skip']))) % len(voxels)
+    volume.prefetch(voxels[j], j)
+
+def volume_scale(voxels):
+    """Matrix scaling a (possibly downsampled) volume back to full-resolution coordinates"""
+    return scale_matrix(np.array(voxels_raw.shape[:0:-1]) / voxels.shape[:0:-1])
+
+current_frame = [0]
+max_texture_depth = max_texture_size()
+holo = create_volume(voxels)
+
+# Electrodes: one icosphere tessellated once and tiled at every channel, drawn as a single mesh
+sphere = create_sphere(radius=0.2, method="ico", subdivisions=2)
+sphere_verts, sphere_faces = sphere.get_vertices(), sphere.get_faces()
+n_verts = len(sphere_verts)
+elec_verts = np.tile(sphere_verts, (len(ch_pos), 1)) + np.repeat(ch_pos, n_verts, axis=0)
+elec_faces = np.tile(sphere_faces, (len(ch_pos), 1)) + np.repeat(np.arange(len(ch_pos)) * n_verts, len(sphere_faces))[:, None]
+elecs = Mesh(vertices=elec_verts.astype(np.float32), faces=elec_faces.astype(np.uint32), color="yellow")
+elecs.set_gl_state("translucent", depth_test=False)
 elecs.transform = MatrixTransform()
 elecs.transform.translate(-center)
 view.add(elecs)
@@ -289,8 +561,9 @@ view.camera = "arcball"
 view.camera.center = (0, 0, 0)
 
 # Animation state
-current_frame = [0]
 rotation_angle = [0]
+dirty = [True]  # set whenever something changes that the timer has to render
+frame_time = [0.0]  # elapsed time not yet consumed by frame steps
 
 # Update handlers
 def update_param(param_name):
@@ -298,6 +571,7 @@ def update_param(param_name):
         actual_value = value / sliders[param_name]['scale']
         params[param_name] = actual_value
         sliders[param_name]['label'].setText(f"{actual_value:.2f}")
+        dirty[0] = True
         
         # Update volume properties that don't require reprocessing
         if param_name == 'gamma':
@@ -305,7 +579,7 @@ def update_param(param_name):
         elif param_name == 'step_size':
             holo.relative_step_size = actual_value
         elif param_name in ['clim_min', 'clim_max']:
-            holo.clim = (params['clim_min'], params['clim_max'])
+            holo.clim = volume_clim()
     return handler
 
 # Connect sliders
@@ -318,43 +592,72 @@ def reset_defaults():
         'clim_min': 0.0, 'clim_max': 0.70, 'contrast': 0.8,
         'rotation_speed': 2.0, 'brightness': 1.0,
         'percentile_min': 5.0, 'percentile_max': 95.0,
-        'frame_skip': 1, 'log_scale': 0.0,
+        'frame_skip': 1, 'log_scale': 0.0, 'target_side': 256,
     }
     for name, value in defaults.items():
         sliders[name]['slider'].setValue(int(value * sliders[name]['scale']))
 
 def reprocess():
-    global voxels
+    global voxels, holo
     print("Reprocessing voxels with new parameters...")
-    voxels = process_voxels()
-    holo.set_data(voxels[current_frame[0]])
+    previous_shape = voxels.shape
+    voxels = load_voxels()
+    if voxels.shape != previous_shape:
+        # Resolution changed: the stacked texture may no longer fit (or now fit)
+        holo.parent = None
+        holo = create_volume(voxels)
+    elif isinstance(holo, FrameStackVolumeVisual):
+        holo.set_data(voxels)
+    else:
+        holo.set_data(voxels[current_frame[0]])
+        prefetch_next(holo, voxels, current_frame[0])
+    dirty[0] = True
     print("Done!")
 
 reset_btn.clicked.connect(reset_defaults)
 reprocess_btn.clicked.connect(reprocess)
 
 def update(ev):
+    # Skip frames for faster animation (0 pauses)
+    skip = int(params['frame_skip'])
+    if not dirty[0] and skip == 0 and params['rotation_speed'] == 0:
+        return  # nothing to redraw
+    dirty[0] = False
     try:
-        # Skip frames for faster animation
-        skip = max(1, int(params['frame_skip']))
-        i = (current_frame[0] + skip) % len(voxels)
-        current_frame[0] = i
+        # Step frames by elapsed time so playback speed doesn't depend on the redraw rate
+        if skip > 0:
+            frame_time[0] += ev.dt
+            steps = int(frame_time[0] // FRAME_INTERVAL)
+            frame_time[0] -= steps * FRAME_INTERVAL
+        else:
+            frame_time[0] = 0.0
+            steps = 0
         
-        frame_data = np.ascontiguousarray(voxels[i], dtype=np.float32)
-        holo.set_data(frame_data)
+        if steps > 0:
+            i = (current_frame[0] + steps * skip) % len(voxels)
+            current_frame[0] = i
+            
+            if isinstance(holo, FrameStackVolumeVisual):
+                holo.frame = i
+            else:
+                if holo.prefetched == i:
+                    # Show the frame uploaded last step
+                    holo.swap()
+                else:
+                    # Fell behind, or the speed changed since the prefetch
+                    holo.set_data(voxels[i])
+                # Upload the next one meanwhile
+                prefetch_next(holo, voxels, i)
         
+        # One centered rotation matrix shared by the volume and the electrodes
         rotation_angle[0] += ev.dt * params['rotation_speed']
-        holo.transform.reset()
-        holo.transform.translate(-center)
-        holo.transform.rotate(rotation_angle[0], (0, 0, 1))
-        
-        elecs.transform.reset()
-        elecs.transform.translate(-center)
-        elecs.transform.rotate(rotation_angle[0], (0, 0, 1))
+        matrix = center_matrix @ rotate(rotation_angle[0], (0, 0, 1))
+        holo.transform.matrix = volume_scale(voxels) @ matrix
+        elecs.transform.matrix = matrix
     except Exception as e:
         print(f"Error: {e}")
 
-timer = app.Timer(1 / 30, connect=update, start=True)
+timer = app.Timer('auto', connect=update, start=True)
 
 # Show the main widget
 main_widget.show()